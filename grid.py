@@ -8,41 +8,73 @@ DIM.
 """
 
 import os
-import sys
 import csv
-import json
+import hashlib
+import orjson
 import tempfile
 import requests
 
-from typing import Dict, Tuple, Set, List
+from concurrent.futures import ThreadPoolExecutor
+from rapidfuzz import process
+from rapidfuzz.distance import Levenshtein
+from requests.adapters import HTTPAdapter
+from typing import Dict, Tuple, Set, List, Optional
 from urllib.parse import urljoin
 
+# share one session across every fetch so repeat requests to bungie.net (and
+# google) reuse the open keep-alive connection instead of re-handshaking.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+class _NameTranslation(dict):
+    """
+    str.translate table that drops anything that isn't alphanumeric or
+    whitespace. Entries are filled in lazily so we don't have to build a table
+    covering all of unicode up front.
+    """
+
+    def __missing__(self, codepoint: int):
+        c = chr(codepoint)
+        value = codepoint if c.isalnum() or c.isspace() else None
+        self[codepoint] = value
+        return value
+
+
+_NAME_TRANSLATION = _NameTranslation()
+
 
 def _normalize_name(name: str) -> str:
-    return " ".join(
-        "".join(c for c in token if c.isalnum()) for token in name.lower().split()
-    )
+    return " ".join(name.lower().translate(_NAME_TRANSLATION).split())
 
 
 def _fetch_grid(sheet_id: str) -> List[Tuple[str, str, str]]:
     csv_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv"
-    resp = requests.get(csv_url)
+    resp = _SESSION.get(csv_url, timeout=30)
     resp.raise_for_status()
 
-    reader = csv.DictReader(
-        line.decode(resp.apparent_encoding) for line in resp.iter_lines()
-    )
+    # sheets exports are always utf-8; setting it explicitly skips requests'
+    # charset detection over the whole body.
+    resp.encoding = "utf-8"
+    reader = csv.reader(resp.text.splitlines())
 
-    return [
-        tuple(_normalize_name(row[col]) for col in ["Name", "Perk 1", "Perk 2"])
-        for row in reader
-    ]
+    header = next(reader)
+    columns = [header.index(col) for col in ["Name", "Perk 1", "Perk 2"]]
 
+    # unlike DictReader, csv.reader yields [] for blank lines; skip them.
+    return [tuple(_normalize_name(row[i]) for i in columns) for row in reader if row]
 
-def _fetch_json(url: str, api_key: str = "") -> Dict:
-    resp = requests.get(url, headers={"X-API-Key": api_key})
+
+def _fetch_bytes(url: str, api_key: str = "") -> bytes:
+    resp = _SESSION.get(url, headers={"X-API-Key": api_key}, timeout=30)
     resp.raise_for_status()
-    return resp.json()
+    return resp.content
+
+
+def _fetch_json(url: str, api_key: str = "") -> Dict:
+    # parse the raw bytes with orjson rather than decoding to a string first;
+    # the item definitions are tens of MB.
+    return orjson.loads(_fetch_bytes(url, api_key))
 
 
 def _fetch_manifest(api_key: str = "") -> Dict:
@@ -57,70 +89,135 @@ def _fetch_manifest(api_key: str = "") -> Dict:
 def _fetch_content(manifest: Dict, key: str, api_key: str = "") -> Dict:
     content_url_path = manifest["jsonWorldComponentContentPaths"]["en"][key]
     content_url = urljoin("https://bungie.net", content_url_path)
-    data = _fetch_json(content_url, api_key)
+    data = _cached_fetch(content_url, api_key)
 
     return data
 
 
-def _weapon_names_and_hashes(categories: Dict, items: Dict) -> Dict[int, str]:
-    """Return a mapping of item hash to name that only contains weapons."""
-    weapon_hash = next(
-        c["hash"]
-        for c in categories.values()
-        if c["displayProperties"]["name"] == "Weapon"
-    )
+def _cached_fetch(
+    url: str, api_key: str = "", cache_dir: str = tempfile.gettempdir()
+) -> Dict:
+    """
+    Fetch a content blob, caching it on disk. Bungie's content paths already
+    include a content hash, so a cached copy never goes stale.
+    """
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    path = os.path.join(cache_dir, url_hash + ".json")
+
+    # a corrupt cache file just means fetching the blob again.
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            try:
+                return orjson.loads(f.read())
+            except ValueError:
+                pass
+        os.unlink(path)
+
+    # cache the response body as-is rather than re-serializing the parsed blob,
+    # but only once it's parsed, so an error page never ends up in the cache.
+    content = _fetch_bytes(url, api_key)
+    data = orjson.loads(content)
+    _write_atomically(path, content)
 
-    return {
-        _normalize_name(v["displayProperties"]["name"]): k
-        for (k, v) in items.items()
-        if weapon_hash in v.get("itemCategoryHashes", [])
-    }
+    return data
 
 
-def _random_roll_perk_ids(item_id: int, items: Dict, plug_sets: Dict) -> Set[int]:
+def _write_atomically(path: str, data: bytes):
+    """
+    Write to a temp file next to `path` and move it into place, so an
+    interrupted run can't leave a partial file behind for the next one to
+    choke on.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _random_roll_perk_ids(socket_entries: List[Dict], plug_sets: Dict) -> Set[int]:
     perk_hashes = set()
+    seen_plug_sets = set()
 
-    for socket_entry in items[str(item_id)].get("sockets", {}).get("socketEntries", []):
+    for socket_entry in socket_entries:
         # filter by whether or not there's a random roll of this socket.
         #
         # maybe also filter by socket type? this seems ok for now.
         if "randomizedPlugSetHash" in socket_entry:
-            plug_set_hash = str(socket_entry["randomizedPlugSetHash"])
-            plug_set_item_hashes = [
-                str(plug["plugItemHash"])
+            plug_set_hash = socket_entry["randomizedPlugSetHash"]
+
+            # several sockets can share a plug set; only read each one once.
+            if plug_set_hash in seen_plug_sets:
+                continue
+            seen_plug_sets.add(plug_set_hash)
+
+            perk_hashes.update(
+                plug["plugItemHash"]
                 for plug in plug_sets[plug_set_hash]["reusablePlugItems"]
-            ]
-            perk_hashes = perk_hashes.union(set(plug_set_item_hashes))
+            )
 
     return perk_hashes
 
 
-def _all_random_roll_perks(
-    categories: Dict, items: Dict, plug_sets: Dict
-) -> Dict[str, int]:
-    """
-    Dump a map from perk hash to perk name by collecting all possible rolls
-    on legendary items.
-    """
-    weapon_hash = next(
-        c["hash"]
-        for c in categories.values()
-        if c["displayProperties"]["name"] == "Weapon"
+def _category_hash(categories: Dict, name: str) -> int:
+    """Return the hash of the item category with the given display name."""
+    return next(
+        c["hash"] for c in categories.values() if c["displayProperties"]["name"] == name
     )
 
+
+def _collect_weapons_and_perks(
+    weapon_hash: int, items: Dict, plug_sets: Dict
+) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """
+    Return a map from weapon name to weapon hash, and a map from perk name to
+    perk hash built by collecting all possible random rolls on those weapons.
+
+    Both come out of a single pass over the (very large) item definitions.
+    """
+    weapons_by_name = {}
     perk_ids = set()
 
-    for item in items.values():
-        if not weapon_hash in item.get("itemCategoryHashes", []):
+    for (k, item) in items.items():
+        item_categories = item.get("itemCategoryHashes")
+        if not item_categories or weapon_hash not in item_categories:
             continue
 
-        perk_ids = perk_ids.union(_random_roll_perk_ids(item["hash"], items, plug_sets))
+        weapons_by_name[_normalize_name(item["displayProperties"]["name"])] = k
+        socket_entries = item.get("sockets", {}).get("socketEntries", ())
+        perk_ids.update(_random_roll_perk_ids(socket_entries, plug_sets))
 
-    return {
+    perks_by_name = {
         _normalize_name(items[perk_id]["displayProperties"]["name"]): perk_id
         for perk_id in perk_ids
     }
 
+    return weapons_by_name, perks_by_name
+
+
+def _match_name(
+    name: str, by_name: Dict[str, int], names: List[str], warnings: List[str]
+) -> Optional[int]:
+    """
+    Look up a hash by normalized name, falling back to the closest name by
+    normalized Levenshtein similarity so small typos in the grid don't drop
+    the whole row. Fuzzy matches are noted in `warnings`.
+    """
+    if name in by_name:
+        return by_name[name]
+
+    match = process.extractOne(
+        name, names, scorer=Levenshtein.normalized_similarity, score_cutoff=0.9
+    )
+    if not match:
+        return None
+
+    warnings.append(f"warning: fuzzy matched {name} to {match[0]}")
+    return by_name[match[0]]
+
 
 def _wishlist_url(weapon_hash: int, perk_hashes: List[int], comment: str) -> str:
     perks = ",".join(str(p) for p in perk_hashes)
@@ -138,44 +235,75 @@ def main():
     # of game data for Destiny 2.
     #
     # once we have the manifest we can pull categories and items to get a list
-    # of all weapons and their API hashes.
+    # of all weapons and their API hashes. the content blobs don't depend on
+    # each other, so download them in parallel.
     manifest = _fetch_manifest()
 
-    items = _fetch_content(manifest, "DestinyInventoryItemDefinition")
-    categories = _fetch_content(manifest, "DestinyItemCategoryDefinition")
-    plug_sets = _fetch_content(manifest, "DestinyPlugSetDefinition")
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        items_future = pool.submit(
+            _fetch_content, manifest, "DestinyInventoryItemDefinition"
+        )
+        categories_future = pool.submit(
+            _fetch_content, manifest, "DestinyItemCategoryDefinition"
+        )
+        plug_sets_future = pool.submit(
+            _fetch_content, manifest, "DestinyPlugSetDefinition"
+        )
+
+        items = items_future.result()
+        categories = categories_future.result()
+        plug_sets = plug_sets_future.result()
+
+    # JSON object keys are always strings, but every hash referenced inside the
+    # definitions is an int. re-key once up front so lookups don't need str().
+    items = {int(k): v for k, v in items.items()}
+    plug_sets = {int(k): v for k, v in plug_sets.items()}
+
+    weapon_hash = _category_hash(categories, "Weapon")
+    weapons_by_name, perks_by_name = _collect_weapons_and_perks(
+        weapon_hash, items, plug_sets
+    )
+    weapon_names = list(weapons_by_name)
+    perk_names = list(perks_by_name)
+
+    # resolve every row up front and report the misses in one go, so writing
+    # the wishlist is just formatting.
+    matched_rolls = []
+    warnings = []
+
+    for weapon, p1, p2 in grid_rolls:
+        item_hash = _match_name(weapon, weapons_by_name, weapon_names, warnings)
+        if not item_hash:
+            warnings.append(f"warning: skipping weapon: missing weapon: {weapon}")
+            continue
 
-    weapons_by_name = _weapon_names_and_hashes(categories, items)
-    perks_by_name = _all_random_roll_perks(categories, items, plug_sets)
+        p1_hash = _match_name(p1, perks_by_name, perk_names, warnings)
+        if not p1_hash:
+            warnings.append(f"warning: skipping weapon: missing perk: {p1}")
+            continue
 
-    with open("./the_grid.tsv", "w") as f:
-        print("title:the grid", file=f)
-        print("description: it's the grid baby", file=f)
-        for weapon, p1, p2 in grid_rolls:
-            item_hash = weapons_by_name.get(weapon)
+        p2_hash = _match_name(p2, perks_by_name, perk_names, warnings)
+        if not p2_hash:
+            warnings.append(f"warning: skipping weapon: missing perk: {p2}")
+            continue
 
-            if not item_hash:
-                print(f"warning: skipping weapon: missing weapon: {weapon}")
-                continue
+        matched_rolls.append((item_hash, p1_hash, p2_hash, weapon, p1, p2))
 
-            p1_hash = perks_by_name.get(p1)
-            if not p1_hash:
-                print(f"warning: skipping weapon: missing perk: {p1}")
-                continue
+    if warnings:
+        print("\n".join(warnings))
 
-            p2_hash = perks_by_name.get(p2)
-            if not p2_hash:
-                print(f"warning: skipping weapon: missing perk: {p2}")
-                continue
+    lines = ["title:the grid", "description: it's the grid baby"]
+    lines.extend(
+        _wishlist_url(
+            item_hash,
+            [p1_hash, p2_hash],
+            f"the grid (season 13) - {weapon}, {p1}, {p2}",
+        )
+        for item_hash, p1_hash, p2_hash, weapon, p1, p2 in matched_rolls
+    )
 
-            print(
-                _wishlist_url(
-                    item_hash,
-                    [p1_hash, p2_hash],
-                    f"the grid (season 13) - {weapon}, {p1}, {p2}",
-                ),
-                file=f,
-            )
+    with open("./the_grid.tsv", "w") as f:
+        f.write("\n".join(lines) + "\n")
 
 
 if __name__ == "__main__":